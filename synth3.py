@@ -1,12 +1,19 @@
+import io
+import os
 import sys
 import boto3
-import hashlib
 import string
 import json
+import orjson
 import time
 import argparse
 import random
 
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from hashlib import sha256 as _sha256
 from random import choices, randrange, sample
 from datetime import datetime, UTC
 from colorama import Fore, Style, init as colorama_init
@@ -21,6 +28,11 @@ class WorkloadConfig:
         self.max_objs = 20
         self.obj_max_size = 10000
 
+        self.assume_snaps_enabled = False
+
+        self.max_workers = 32
+        self.read_chunk_size = 65536
+
 def sizeof_fmt(num, suffix="B"):
     for unit in ("", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"):
         if abs(num) < 1024.0:
@@ -28,14 +40,20 @@ def sizeof_fmt(num, suffix="B"):
         num /= 1024.0
     return f"{num:.1f}Yi{suffix}"
 
-def sha256(data):
-    return hashlib.sha256(data).hexdigest()
+TEXT_ALPHABET = string.ascii_letters + string.digits + " "
+
+MAX_COPY_OBJECT_SIZE = 5 * 1024 ** 3
+MULTIPART_THRESHOLD = 8 * 1024 ** 2
 
 def random_text(length):
-    return ''.join(choices(string.ascii_letters + string.digits + " ", k=length))
+    return ''.join(choices(TEXT_ALPHABET, k=length))
 
 def enable_snapshots(env):
+    if env.snaps_enabled:
+        return
+
     env.s3.put_bucket_snapshots_configuration(Bucket = env.conf.bucket_name, BucketSnapsConf = { 'Enabled': True } )
+    env.snaps_enabled = True
 
 def create_snapshot(env, snap_name, description):
     enable_snapshots(env)
@@ -83,43 +101,76 @@ def get_snap_id(env, snap_id, snap_name):
 
     return snap_id
 
-def list_objects(env, snap_range = None):
+def list_objects(env, snap_range = None, prefix = None):
     eff_snap_range = snap_range or env.snap_range
-    if eff_snap_range is None:
-        return env.s3.list_objects(Bucket=env.conf.bucket_name)['Contents']
-    else:
-        result = env.s3.list_objects(Bucket=env.conf.bucket_name, SnapRange = eff_snap_range)
-        return result.get('Contents', [])
+    params = { 'Bucket': env.conf.bucket_name }
+    if prefix:
+        params['Prefix'] = prefix
+    if eff_snap_range is not None:
+        params['SnapRange'] = eff_snap_range
 
-def get_object_key(env, obj_id):
-    return f"{env.conf.prefix}object_{obj_id}.txt"
+    # generator, callers can start working on the first page while the rest is listed
+    paginator = env.s3.get_paginator('list_objects')
+    for page in paginator.paginate(PaginationConfig = { 'PageSize': 1000 }, **params):
+        yield from page.get('Contents', [])
 
 def load_metadata(env):
     print(f"loading {env.conf.bucket_name}/{env.conf.metadata_object_key}")
     try:
-        metadata_content = get_object(env, env.conf.bucket_name, env.conf.metadata_object_key)
-        return json.loads(metadata_content)
+        metadata_content = get_object_bytes(env, env.conf.bucket_name, env.conf.metadata_object_key)
+        metadata = orjson.loads(metadata_content)
     except Exception as e:
         print(e)
+        return { 'objects': {},
+                'generated_at': None }
 
-    return { 'objects': {},
-            'generated_at': None }
+    # object ids are stored as ints in memory, JSON only has string keys.
+    # done outside the try so bad ids fail instead of the metadata being reset
+    metadata['objects'] = { int(obj_id): obj_meta for obj_id, obj_meta in metadata['objects'].items() }
+    return metadata
 
-def get_object(env, bucket_name, key, snap_id = None):
+def get_object_bytes(env, bucket_name, key, snap_id = None, hasher = None):
     eff_snap_id = snap_id or env.snap_id
     if eff_snap_id is None:
         response = env.s3.get_object(Bucket=bucket_name, Key=key)
     else:
         response = env.s3.get_object(Bucket=bucket_name, Key=key, SnapId=int(eff_snap_id))
-    return response['Body'].read().decode('utf-8')
+
+    if hasher is None:
+        return response['Body'].read()
+
+    # hash the body as it arrives, returns the digest instead of the data.
+    # hashlib releases the GIL on these chunk sizes, so concurrent callers
+    # hash on separate cores.
+    for chunk in response['Body'].iter_chunks(chunk_size=env.conf.read_chunk_size):
+        hasher.update(chunk)
+    return hasher.hexdigest()
 
 def put_object(env, bucket_name, key, data):
-    env.s3.put_object(Bucket=bucket_name, Key=key, Body=data)
+    if len(data) > MULTIPART_THRESHOLD:
+        # upload the parts concurrently
+        env.s3.upload_fileobj(io.BytesIO(data), bucket_name, key, Config=env.transfer_config)
+    else:
+        env.s3.put_object(Bucket=bucket_name, Key=key, Body=data)
+
+def copy_object(env, src_bucket_name, dest_bucket_name, key, size):
+    copy_source = { 'Bucket': src_bucket_name, 'Key': key }
+    if size > MAX_COPY_OBJECT_SIZE:
+        # CopyObject is limited to 5GiB, use a managed multipart copy
+        env.s3.copy(copy_source, dest_bucket_name, key, Config=env.transfer_config)
+    else:
+        env.s3.copy_object(Bucket=dest_bucket_name, Key=key, CopySource=copy_source)
 
 class Env:
     def __init__(self, conf, init_snapshot = True):
         self.conf = conf
-        self.s3 = boto3.client("s3")
+        self.s3_config = Config(max_pool_connections = conf.max_workers,
+                                tcp_keepalive = True,
+                                retries = { 'mode': 'adaptive', 'max_attempts': 5 })
+        # clients are thread safe, all the workers share this one and its connection pool
+        self.s3 = boto3.client("s3", config=self.s3_config)
+        self.transfer_config = TransferConfig(multipart_threshold = MULTIPART_THRESHOLD, max_concurrency = 8)
+        self.snaps_enabled = conf.assume_snaps_enabled
 
         self.snap_name = conf.snap_name
         self.from_snap_name = conf.from_snap_name
@@ -141,73 +192,73 @@ class Env:
         elif conf.from_snap_id is not None:
             self.snap_range = f"{conf.from_snap_id}-{snap_id_str}"
 
-
 class SyntheticS3Workload:
     def __init__(self, env):
         self.env = env
         self.conf = env.conf
+        self.key_template = self.conf.prefix + "object_{}.txt"
         env.s3.create_bucket(Bucket=self.conf.bucket_name)
         self.metadata = load_metadata(env)
 
     def gen_object(self, obj_id):
         object_size = randrange(self.conf.obj_max_size)
-        content = random_text(object_size)
-        content_bytes = content.encode('utf-8')
-        hash_digest = sha256(content_bytes)
-        object_key = get_object_key(self.env, obj_id)
+        content_bytes = os.urandom(object_size)
+        hash_digest = _sha256(content_bytes).hexdigest()
+        object_key = self.key_template.format(obj_id)
 
         put_object(self.env, self.conf.bucket_name, object_key, content_bytes)
 
-        print(f"uploaded: {object_key}\tsize={object_size}\thash={hash_digest}")
-
         obj_meta = {
             "object_key": object_key,
             "size": object_size,
             "sha256": hash_digest
         }
 
-        return obj_meta
+        return obj_id, obj_meta
 
 
     def generate_objects(self):
         num_objs = randrange(self.conf.max_objs) + 1
         obj_ids = random.sample(range(1, 100), num_objs)
-        for obj_id in sorted(obj_ids):
-            obj_meta = self.gen_object(obj_id)
+        # map() keeps the results in id order so output stays sorted
+        with ThreadPoolExecutor(max_workers=self.conf.max_workers) as executor:
+            for obj_id, obj_meta in executor.map(self.gen_object, sorted(obj_ids)):
+                print(f"uploaded: {obj_meta['object_key']}\tsize={obj_meta['size']}\thash={obj_meta['sha256']}")
 
-            self.metadata['objects'][str(obj_id)] = obj_meta
+                self.metadata['objects'][obj_id] = obj_meta
 
         print(f'Created {num_objs} objects')
 
 
     def flush_meta(self):
-        self.metadata["generated_at"] = datetime.now(UTC).isoformat() + "Z",
-        metadata_json = json.dumps(self.metadata)
-
-        objs_json = json.dumps(self.metadata['objects'])
+        self.metadata["generated_at"] = datetime.now(UTC).isoformat() + "Z"
+        metadata_bytes = orjson.dumps(self.metadata, option=orjson.OPT_NON_STR_KEYS)
 
-        hash_digest = sha256(objs_json.encode('utf-8'))
-        put_object(self.env, self.conf.bucket_name, self.conf.metadata_object_key, metadata_json.encode("utf-8"))
+        hash_digest = _sha256(metadata_bytes).hexdigest()
+        put_object(self.env, self.conf.bucket_name, self.conf.metadata_object_key, metadata_bytes)
 
         print(f"Uploaded metadata to: s3://{self.conf.bucket_name}/{self.conf.metadata_object_key}")
         print(f"meta hash: {hash_digest}")
 
+    def fetch_hash(self, key):
+        try:
+            return get_object_bytes(self.env, self.conf.bucket_name, key, hasher=_sha256())
+        except:
+            return '<error>'
+
     def validate(self):
 
         success = True
         fail_count = 0
 
-        for obj_id, obj_info in dict(sorted(self.metadata['objects'].items(), key=lambda item: int(item[0]))).items():
-            key = obj_info['object_key']
-            size = obj_info['size']
-            obj_hash = obj_info['sha256']
+        objs = [ (obj_id, obj_info['object_key'], obj_info['sha256'])
+                 for obj_id, obj_info in sorted(self.metadata['objects'].items()) ]
 
-            try:
-                actual_obj_data = get_object(self.env, self.conf.bucket_name, key)
-                actual_hash = sha256(actual_obj_data.encode('utf8'))
-            except:
-                actual_hash = '<error>'
+        # fetch concurrently, map() keeps the results in order so output stays sorted
+        with ThreadPoolExecutor(max_workers=self.conf.max_workers) as executor:
+            actual_hashes = list(executor.map(self.fetch_hash, [ key for _, key, _ in objs ]))
 
+        for (obj_id, key, obj_hash), actual_hash in zip(objs, actual_hashes):
             if actual_hash == obj_hash:
                 result_str = Fore.GREEN + 'OK'
             else:
@@ -232,14 +283,35 @@ class SyntheticS3Workload:
             if not incremental:
                 snap_range = '-' + snap_range
 
-        for key in list_objects(self.env, snap_range = snap_range):
-            k = key['Key']
-            if not k.startswith(self.conf.prefix):
-                continue
-            print(f'copying {self.conf.bucket_name}/{k} -> {dest_bucket}/{k}')
+        fail_count = 0
+
+        with ThreadPoolExecutor(max_workers=self.conf.max_workers) as executor:
+            futures = {}
+            for key in list_objects(self.env, snap_range = snap_range, prefix = self.conf.prefix):
+                k = key['Key']
+                print(f'copying {self.conf.bucket_name}/{k} -> {dest_bucket}/{k}')
 
-            obj_data = get_object(self.env, self.conf.bucket_name, k, snap_id)
-            put_object(self.env, dest_bucket, k, obj_data)
+                futures[executor.submit(self.copy_key, dest_bucket, k, key['Size'], snap_id)] = k
+
+            # keep copying the rest when a single object fails, report at the end
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(Fore.RED + f'ERROR: failed copying {self.conf.bucket_name}/{futures[future]}: {e}')
+                    fail_count += 1
+
+        if fail_count:
+            raise Exception(Fore.RED + f'ERROR: failed copying {fail_count} objects to {dest_bucket}')
+
+    def copy_key(self, dest_bucket, k, size, snap_id = None):
+        if (snap_id or self.env.snap_id) is None:
+            copy_object(self.env, self.conf.bucket_name, dest_bucket, k, size)
+            return
+
+        # reading a snapshot needs SnapId on the GET, so copy through the client
+        obj_data = get_object_bytes(self.env, self.conf.bucket_name, k, snap_id)
+        put_object(self.env, dest_bucket, k, obj_data)
 
     def sync_bucket(self, dest_bucket, follow_snaps, cur_snap_id, incremental):
         if not follow_snaps:
@@ -289,6 +361,8 @@ def main():
     parser.add_argument('--follow-snapshots', action='store_true')
     parser.add_argument('--auto-snap', action='store_true')
     parser.add_argument('--auto-snap-ratio', type=int, default=5)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--assume-snaps-enabled', action='store_true')
 
     args = parser.parse_args()
 
@@ -297,11 +371,13 @@ def main():
 
     conf.bucket_name = args.bucket
     conf.prefix = args.prefix or conf.prefix
+    conf.max_workers = args.workers or conf.max_workers
     conf.snap_id = args.snap_id
     conf.snap_name = args.snap_name
     conf.from_snap_id = args.from_snap_id
     conf.from_snap_name = args.from_snap_name
     conf.all_objs = args.all_objs
+    conf.assume_snaps_enabled = args.assume_snaps_enabled
 
     init_snapshot = args.command != 'create-snapshot'
     env = Env(conf, init_snapshot=init_snapshot)
@@ -336,18 +412,19 @@ def main():
         print(json.dumps(snaps_by_name, indent=4, default=str))
 
     elif args.command == 'list-objects':
+        total_size = 0
+        num_objs = 0
         try:
-            objs = list_objects(env)
+            for o in list_objects(env):
+                print(f"{o['Key']:<28} {o['Size']:>10} {str(o['LastModified'])}")
+                # print(o['Key'] + ' ' + str(o['size']) + ' ' str(o['Date']))
+                total_size += o['Size']
+                num_objs += 1
         except Exception as e:
             print(e)
             sys.exit(1)
 
-        total_size = 0
-        for o in objs:
-            print(f"{o['Key']:<28} {o['Size']:>10} {str(o['LastModified'])}")
-            # print(o['Key'] + ' ' + str(o['size']) + ' ' str(o['Date']))
-            total_size += o['Size']
-        print(f'\nTotal: {len(objs)} objects / {sizeof_fmt(total_size)}')
+        print(f'\nTotal: {num_objs} objects / {sizeof_fmt(total_size)}')
 
     elif args.command == 'get-meta':
         meta = load_metadata(env)